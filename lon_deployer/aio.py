@@ -0,0 +1,224 @@
+import asyncio
+import contextlib
+import pathlib
+import stat
+import struct
+import subprocess
+from dataclasses import dataclass
+from time import time
+from typing import AsyncIterator, Awaitable, TypeVar
+
+from adbutils.errors import AdbError, AdbTimeout
+
+from . import exceptions
+from .fastboot import BOOT_UNAUTHORIZED, fastboot_cmd
+from .utils import logger, console
+
+ADB_HOST = "127.0.0.1"
+ADB_PORT = 5037
+SYNC_DATA_MAX = 65536
+# Timeout of one chunk write on stream connections
+WRITE_TIMEOUT = 60
+
+T = TypeVar("T")
+
+
+@dataclass
+class ShellResult:
+    returncode: int
+    output: str
+
+
+async def _adb_timeout(aw: Awaitable[T], timeout: float | None) -> T:
+    try:
+        return await asyncio.wait_for(aw, timeout)
+    except asyncio.TimeoutError:
+        raise AdbTimeout(f"Timed out after {timeout}s")
+
+
+class AdbConnection:
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.reader = reader
+        self.writer = writer
+
+    async def write(self, data: bytes, timeout: float | None = None) -> None:
+        self.writer.write(data)
+        await _adb_timeout(self.writer.drain(), timeout)
+
+    async def send_command(self, cmd: str) -> None:
+        data = cmd.encode()
+        await self.write(f"{len(data):04x}".encode() + data)
+
+    async def read(self, size: int) -> bytes:
+        try:
+            return await self.reader.readexactly(size)
+        except asyncio.IncompleteReadError:
+            raise AdbError("connection closed")
+
+    async def read_until_close(self) -> bytes:
+        return await self.reader.read()
+
+    async def check_okay(self) -> None:
+        data = await self.read(4)
+        if data == b"FAIL":
+            size = int(await self.read(4), 16)
+            raise AdbError((await self.read(size)).decode(errors="replace"))
+        elif data != b"OKAY":
+            raise AdbError(f"Unknown data: {data!r}")
+
+    async def close(self) -> None:
+        self.writer.close()
+        with contextlib.suppress(ConnectionError):
+            await self.writer.wait_closed()
+
+
+@contextlib.asynccontextmanager
+async def connect(host: str = ADB_HOST, port: int = ADB_PORT) -> AsyncIterator[AdbConnection]:
+    reader, writer = await asyncio.open_connection(host, port)
+    conn = AdbConnection(reader, writer)
+    try:
+        yield conn
+    finally:
+        await conn.close()
+
+
+async def wait_for(serial: str, state: str = "device", transport: str = "any", timeout: float | None = 60,
+                   host: str = ADB_HOST, port: int = ADB_PORT) -> None:
+    async def wait() -> None:
+        async with connect(host, port) as conn:
+            await conn.send_command(f"host-serial:{serial}:wait-for-{transport}-{state}")
+            await conn.check_okay()
+            await conn.check_okay()
+
+    await _adb_timeout(wait(), timeout)
+
+
+async def wait_for_bootloader(serial: str, timeout: float | None = 60) -> None:
+    """Fastboot waits for device to appear. Raises DeviceNotFound on timeout"""
+    await fastboot(["getvar", "product"], serial, timeout)
+
+
+class AsyncDevice:
+    """Asyncio counterpart of adbutils.AdbDevice for operations used by deployer"""
+
+    def __init__(self, serial: str, host: str = ADB_HOST, port: int = ADB_PORT):
+        self.serial = serial
+        self.host = host
+        self.port = port
+
+    async def _open(self, conn: AdbConnection, service: str) -> None:
+        await conn.send_command(f"host:transport:{self.serial}")
+        await conn.check_okay()
+        await conn.send_command(service)
+        await conn.check_okay()
+
+    @contextlib.asynccontextmanager
+    async def _transport(self, service: str) -> AsyncIterator[AdbConnection]:
+        async with connect(self.host, self.port) as conn:
+            await self._open(conn, service)
+            yield conn
+
+    @contextlib.asynccontextmanager
+    async def _sync(self, path: str, cmd: str) -> AsyncIterator[AdbConnection]:
+        async with self._transport("sync:") as conn:
+            path = path.encode()
+            await conn.write(cmd.encode() + struct.pack("<I", len(path)) + path)
+            yield conn
+
+    async def shell(self, cmd: str, timeout: float | None = None) -> str:
+        async def run() -> str:
+            async with self._transport(f"shell:{cmd}") as conn:
+                return (await conn.read_until_close()).decode(errors="replace").rstrip()
+
+        return await _adb_timeout(run(), timeout)
+
+    async def shell2(self, cmd: str, timeout: float | None = None) -> ShellResult:
+        magic = "X4EXIT:"
+        output = await self.shell(f"{cmd}; echo {magic}$?", timeout=timeout)
+        index = output.rfind(magic)
+        if index == -1:
+            raise AdbError("shell output invalid", cmd, output)
+        return ShellResult(int(output[index + len(magic):]), output[:index])
+
+    async def push(self, src: bytes | pathlib.Path, dst: str, mode: int = 0o755,
+                   timeout: float | None = None) -> None:
+        async def run() -> None:
+            async with self._sync(f"{dst},{stat.S_IFREG | mode}", "SEND") as conn:
+                with contextlib.ExitStack() as stack:
+                    if isinstance(src, pathlib.Path):
+                        file = stack.enter_context(open(src, "rb"))
+                        chunks = iter(lambda: file.read(SYNC_DATA_MAX), b"")
+                    else:
+                        chunks = (src[i:i + SYNC_DATA_MAX] for i in range(0, len(src), SYNC_DATA_MAX))
+                    for chunk in chunks:
+                        await conn.write(b"DATA" + struct.pack("<I", len(chunk)) + chunk)
+                await conn.write(b"DONE" + struct.pack("<I", int(time())))
+                status, size = struct.unpack("<4sI", await conn.read(8))
+                if status == b"FAIL":
+                    raise AdbError((await conn.read(size)).decode(errors="replace"), dst)
+                elif status != b"OKAY":
+                    raise AdbError(f"Unknown data: {status!r}")
+
+        await _adb_timeout(run(), timeout)
+
+    async def iter_content(self, path: str, timeout: float | None = None) -> AsyncIterator[bytes]:
+        """Pull file from device. Timeout is applied to every chunk"""
+        async with self._sync(path, "RECV") as conn:
+            while True:
+                cmd, size = struct.unpack("<4sI", await _adb_timeout(conn.read(8), timeout))
+                if cmd == b"DONE":
+                    break
+                data = await _adb_timeout(conn.read(size), timeout)
+                if cmd == b"FAIL":
+                    raise AdbError(data.decode(errors="replace"), path)
+                elif cmd != b"DATA":
+                    raise AdbError(f"Invalid sync cmd: {cmd!r}")
+                yield data
+
+    @contextlib.asynccontextmanager
+    async def create_connection(self, port: int, timeout: float | None = 10) -> AsyncIterator[AdbConnection]:
+        """Connect to tcp port on device"""
+        async with connect(self.host, self.port) as conn:
+            await _adb_timeout(self._open(conn, f"tcp:{port}"), timeout)
+            yield conn
+
+    async def reboot(self, mode: str = "", timeout: float | None = 10) -> None:
+        async def run() -> None:
+            async with self._transport(f"reboot:{mode}") as conn:
+                await conn.read_until_close()
+
+        await _adb_timeout(run(), timeout)
+
+
+async def fastboot(command: list[str], serial: str | None = None, timeout: float | None = 60) -> str:
+    cmd = fastboot_cmd(command, serial)
+    logger.debug(f"fb-cmd: {cmd}")
+    try:
+        proc = await asyncio.create_subprocess_exec(*cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    except FileNotFoundError:
+        console.log("Fastboot binary not found")
+        console.log("Exiting")
+        exit(1)
+    try:
+        fb_out, _ = await asyncio.wait_for(proc.communicate(), timeout)
+    except asyncio.TimeoutError:
+        raise exceptions.DeviceNotFound("Timed out")
+    finally:
+        if proc.returncode is None:
+            proc.kill()
+            await proc.wait()
+    logger.debug(f"fb-out: {fb_out}")
+    if proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, cmd, fb_out)
+    return fb_out.decode()
+
+
+async def fastboot_boot(serial: str, image: str, timeout: float | None = 60) -> None:
+    try:
+        out = await fastboot(["boot", image], serial, timeout)
+    except subprocess.CalledProcessError as e:
+        out = e.output.decode(errors="replace")
+        if BOOT_UNAUTHORIZED not in out:
+            raise
+    if BOOT_UNAUTHORIZED in out:
+        raise exceptions.UnauthorizedBootImage(BOOT_UNAUTHORIZED, out)
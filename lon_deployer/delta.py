@@ -0,0 +1,162 @@
+import asyncio
+import hashlib
+import json
+import pathlib
+
+from adbutils.errors import AdbError, AdbTimeout
+
+from . import aio
+from . import exceptions
+from .events import bus
+from .utils import get_port, logger, console
+
+BLOCK_SIZE = 4 * 1024 * 1024
+LINUX_PART = "/dev/block/platform/soc/1d84000.ufshc/by-name/linux"
+
+
+def index_path(image: pathlib.Path) -> pathlib.Path:
+    return image.with_name(image.name + ".blockidx")
+
+
+def build_index(image: pathlib.Path, block_size: int = BLOCK_SIZE) -> list[str]:
+    """Return md5 hashes of image blocks. Index is cached beside the image"""
+    stat = image.stat()
+    cache = index_path(image)
+    try:
+        with open(cache, "r") as file:
+            index = json.load(file)
+        if (index["size"], index["mtime"], index["block_size"]) == (stat.st_size, stat.st_mtime_ns, block_size):
+            logger.debug(f"Using block index {cache}")
+            return index["hashes"]
+    except (FileNotFoundError, ValueError, KeyError):
+        pass
+
+    hashes = []
+    with bus.transfer("[cyan]Indexing RootFS", stat.st_size) as transfer:
+        with open(image, "rb") as file:
+            while block := file.read(block_size):
+                hashes.append(hashlib.md5(block).hexdigest())
+                transfer.advance(len(block))
+
+    try:
+        with open(cache, "w") as file:
+            json.dump({
+                "size": stat.st_size,
+                "mtime": stat.st_mtime_ns,
+                "block_size": block_size,
+                "hashes": hashes
+            }, file)
+    except OSError as e:
+        logger.debug(f"Unable to save block index: {e}")
+    return hashes
+
+
+def changed_runs(local: list[str], remote: list[str]) -> list[tuple[int, int]]:
+    """Group differing blocks into (first block, block count) runs"""
+    runs = []
+    for i, block_hash in enumerate(local):
+        if i < len(remote) and remote[i] == block_hash:
+            continue
+        if runs and sum(runs[-1]) == i:
+            runs[-1] = (runs[-1][0], runs[-1][1] + 1)
+        else:
+            runs.append((i, 1))
+    return runs
+
+
+def _hash_script(size: int, block_size: int, runs: list[tuple[int, int]]) -> str:
+    full, tail = divmod(size, block_size)
+    lines = []
+    for start, count in runs:
+        lines += [
+            f"i={start}",
+            f"while [ $i -lt {min(start + count, full)} ]; do",
+            f"  busybox dd if={LINUX_PART} bs={block_size} skip=$i count=1 2>/dev/null | busybox md5sum",
+            "  i=$((i + 1))",
+            "done"
+        ]
+        if tail and start + count > full:
+            lines.append(
+                f"busybox dd if={LINUX_PART} bs={block_size} skip={full} count=1 2>/dev/null"
+                f" | busybox head -c {tail} | busybox md5sum"
+            )
+    return "\n".join(lines) + "\n"
+
+
+def _write_script(port: int, runs: list[tuple[int, int]], block_size: int) -> str:
+    # Stop on first failed dd and exit with its status
+    writes = [
+        f"  busybox dd of={LINUX_PART} bs={block_size} seek={start} count={count} iflag=fullblock conv=notrunc"
+        for start, count in runs
+    ]
+    lines = [f"busybox nc -l 127.0.0.1:{port} | {{", " &&\n".join(writes), "}", "status=$?", "sync",
+             "exit $status"]
+    return "\n".join(lines) + "\n"
+
+
+async def device_index(device: aio.AsyncDevice, size: int, block_size: int = BLOCK_SIZE,
+                       runs: list[tuple[int, int]] | None = None) -> list[str]:
+    """Hash blocks of linux partition. By default all blocks covered by size are hashed"""
+    if runs is None:
+        runs = [(0, -(-size // block_size))]
+    await device.push(_hash_script(size, block_size, runs).encode(), "/tmp/delta-hash.sh")
+    console.log("Hashing linux partition")
+    output = await device.shell("sh /tmp/delta-hash.sh")
+    hashes = [line.split()[0] for line in output.splitlines() if line.strip()]
+    if not all(len(x) == 32 for x in hashes):
+        raise exceptions.DeltaError("Unexpected md5sum output")
+    return hashes
+
+
+async def flash(device: aio.AsyncDevice, image: pathlib.Path, index: list[str],
+                block_size: int = BLOCK_SIZE) -> int:
+    """Write blocks of image that differ from linux partition. Returns number of blocks sent"""
+    size = image.stat().st_size
+    remote = await device_index(device, size, block_size)
+    if len(remote) != len(index):
+        raise exceptions.DeltaError(f"Expected {len(index)} block hashes, got {len(remote)}")
+
+    runs = changed_runs(index, remote)
+    changed = sum(count for _, count in runs)
+    console.log(f"{changed} of {len(index)} blocks changed")
+    if not runs:
+        return 0
+
+    server_port = get_port()
+    await device.push(_write_script(server_port, runs, block_size).encode(), "/tmp/delta-write.sh")
+    nc_task = asyncio.create_task(device.shell2("sh /tmp/delta-write.sh"))
+    try:
+        await asyncio.sleep(3)
+
+        total = sum(min(count * block_size, size - start * block_size) for start, count in runs)
+        try:
+            async with device.create_connection(server_port) as conn:
+                with bus.transfer("[cyan]Uploading changed blocks", total, device.serial) as transfer:
+                    with open(image, "rb") as file:
+                        for start, count in runs:
+                            file.seek(start * block_size)
+                            left = count * block_size
+                            while left > 0:
+                                data = file.read(min(left, 1048576))
+                                if not data:
+                                    break
+                                await conn.write(data, timeout=aio.WRITE_TIMEOUT)
+                                transfer.advance(len(data))
+                                left -= len(data)
+        except AdbTimeout:
+            # Stalled device will not take full image either
+            raise
+        except (ConnectionError, AdbError) as e:
+            raise exceptions.DeltaError(f"Upload of changed blocks failed: {e}")
+        result = await nc_task
+    finally:
+        nc_task.cancel()
+    if result.returncode != 0:
+        raise exceptions.DeltaError(f"Writing changed blocks failed: {result.output}")
+
+    console.log("Verifying written blocks")
+    written = await device_index(device, size, block_size, runs)
+    expected = [index[i] for start, count in runs for i in range(start, start + count)]
+    if written != expected:
+        raise exceptions.DeltaError("Written blocks do not match RootFS")
+    return changed
@@ -0,0 +1,159 @@
+import contextlib
+import itertools
+import json
+import sys
+import threading
+from time import monotonic, time
+from typing import Iterator, TextIO
+
+from rich.text import Text
+
+from .utils import get_progress
+
+
+class Transfer:
+    """Counter bumped by transfer loops. Sinks read it from sampling thread"""
+    __slots__ = ("id", "description", "total", "device", "completed", "finished", "started")
+
+    def __init__(self, transfer_id: int, description: str, total: int | None, device: str | None):
+        self.id = transfer_id
+        self.description = description
+        self.total = total
+        self.device = device
+        self.completed = 0
+        self.finished = False
+        self.started = monotonic()
+
+    def advance(self, size: int) -> None:
+        self.completed += size
+
+
+class NullSink:
+    # Seconds between samples. None disables sampling
+    interval: float | None = None
+
+    def start(self) -> None:
+        pass
+
+    def sample(self, transfers: list[Transfer]) -> None:
+        pass
+
+    def stop(self) -> None:
+        pass
+
+    def event(self, name: str, fields: dict) -> None:
+        pass
+
+
+class RichSink(NullSink):
+    interval = 0.1
+
+    def __init__(self):
+        self._progress = None
+        self._tasks = {}
+
+    def start(self) -> None:
+        self._progress = get_progress()
+        self._progress.start()
+
+    def sample(self, transfers: list[Transfer]) -> None:
+        for transfer in transfers:
+            task = self._tasks.get(transfer.id)
+            if task is None:
+                task = self._tasks[transfer.id] = self._progress.add_task(transfer.description, total=transfer.total)
+            self._progress.update(task, completed=transfer.completed)
+
+    def stop(self) -> None:
+        self._progress.stop()
+        self._progress = None
+        self._tasks = {}
+
+
+class JsonSink(NullSink):
+    """Writes progress samples and events as JSON lines"""
+
+    def __init__(self, stream: TextIO | None = None, interval: float = 1):
+        self.stream = stream or sys.stdout
+        self.interval = interval
+        self._last = {}
+
+    def _write(self, record: dict) -> None:
+        record["time"] = round(time(), 3)
+        self.stream.write(json.dumps(record) + "\n")
+        self.stream.flush()
+
+    def sample(self, transfers: list[Transfer]) -> None:
+        now = monotonic()
+        for transfer in transfers:
+            last_time, last_completed = self._last.get(transfer.id, (transfer.started, 0))
+            rate = (transfer.completed - last_completed) / (now - last_time) if now > last_time else 0
+            self._last[transfer.id] = (now, transfer.completed)
+            self._write({
+                "type": "progress",
+                "device": transfer.device,
+                "task": Text.from_markup(transfer.description).plain,
+                "completed": transfer.completed,
+                "total": transfer.total,
+                "rate": round(rate),
+                "done": transfer.finished
+            })
+
+    def stop(self) -> None:
+        self._last = {}
+
+    def event(self, name: str, fields: dict) -> None:
+        self._write({"type": "event", "event": name, **fields})
+
+
+class EventBus:
+    """Routes transfer progress and events to a sink.
+
+    Transfer loops only bump counters. Sink samples them at its own interval
+    from a background thread and once more when a transfer is finished.
+    """
+
+    def __init__(self, sink: NullSink):
+        self.sink = sink
+        self._transfers: list[Transfer] = []
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    def _sample(self) -> None:
+        while True:
+            if self._wake.wait(self.sink.interval):
+                self._wake.clear()
+            with self._lock:
+                if not self._transfers:
+                    self._thread = None
+                    return
+                self.sink.sample(self._transfers)
+
+    @contextlib.contextmanager
+    def transfer(self, description: str, total: int | None, device: str | None = None) -> Iterator[Transfer]:
+        transfer = Transfer(next(self._ids), description, total, device)
+        with self._lock:
+            if not self._transfers:
+                self.sink.start()
+            self._transfers.append(transfer)
+            if self._thread is None and self.sink.interval is not None:
+                self._thread = threading.Thread(target=self._sample, daemon=True)
+                self._thread.start()
+        try:
+            yield transfer
+        finally:
+            transfer.finished = True
+            with self._lock:
+                self.sink.sample([transfer])
+                self._transfers.remove(transfer)
+                if not self._transfers:
+                    self.sink.stop()
+                    self._wake.set()
+
+    def event(self, name: str, **fields) -> None:
+        with self._lock:
+            self.sink.event(name, fields)
+
+
+bus = EventBus(RichSink())
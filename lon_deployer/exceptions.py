@@ -20,3 +20,15 @@ class UnsupportedPlatform(Exception):
     def __init__(self, platform):
         super().__init__(f"{platform} is not supported")
         self.platform = platform
+
+
+class DeltaError(Exception):
+    pass
+
+
+class ArtifactError(Exception):
+    pass
+
+
+class SchedulerError(Exception):
+    pass
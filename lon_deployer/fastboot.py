@@ -4,14 +4,18 @@ import subprocess
 from . import files, exceptions
 from .utils import logger, console
 
+BOOT_UNAUTHORIZED = "Failed to load/authenticate boot image: Device Error"
+
+
+def fastboot_cmd(command: list[str], serial: str | None = None) -> list[str]:
+    if not serial:
+        return ["fastboot"] + command
+    return ["fastboot", "-s", serial] + command
+
 
 def _fastboot_run(command: list[str], serial: str | None = None) -> str:
     try:
-        cmd = ["fastboot"]
-        if not serial:
-            cmd += command
-        else:
-            cmd += ["-s", serial] + command
+        cmd = fastboot_cmd(command, serial)
         logger.debug(f"fb-cmd: {cmd}")
         fb_out = subprocess.check_output(cmd, stderr=subprocess.STDOUT, timeout=60)
         logger.debug(f"fb-out: {fb_out}")
@@ -53,12 +57,11 @@ def reboot(serial: str) -> None:
 
 
 def boot_ofox(serial: str) -> None:
-    files.OrangeFox.get()
-    ofox = files.OrangeFox.filepath
+    ofox = files.OrangeFox.get_path()
     with console.status("[cyan]Booting", spinner="line", spinner_style="white"):
         out = _fastboot_run(["boot", ofox], serial)
-        if "Failed to load/authenticate boot image: Device Error" in out:
-            raise exceptions.UnauthorizedBootImage("Failed to load/authenticate boot image: Device Error", out)
+        if BOOT_UNAUTHORIZED in out:
+            raise exceptions.UnauthorizedBootImage(BOOT_UNAUTHORIZED, out)
 
 
 def flash(serial: str, part: str, data: bytes) -> None:
@@ -78,10 +81,5 @@ def restore_parts(serial: str) -> None:
     flash(serial, "userdata", userdata)
 
 
-def clean_device(serial: str) -> None:
-    _fastboot_run(["erase", "linux"], serial=serial)
-    _fastboot_run(["erase", "esp"], serial=serial)
-
-
 def wait_for_bootloader(serial: str) -> None:
     _fastboot_run(["getvar", "product"], serial=serial)
@@ -1,21 +1,81 @@
 import os
 import json
 import urllib.parse
+import zipfile
 import requests
 import hashlib
 from os import path as op
 from os import getcwd as pwd
-from rich.console import Console
 
-from .utils import get_progress
+from . import exceptions
+from .events import bus
+from .utils import console
 
-console = Console(log_path=False)
+SERVER = "https://timoxa0.su"
+BUNDLE_INDEX = "index.json"
+REQUEST_TIMEOUT = 10
+
+
+class Bundle:
+    """Zip archive of stored (uncompressed) artifacts with index of their sizes and md5 sums"""
+
+    def __init__(self, path: str):
+        self.path = path
+        with zipfile.ZipFile(path) as archive:
+            self.index = json.loads(archive.read(BUNDLE_INDEX))["files"]
+        if not isinstance(self.index, dict):
+            raise ValueError("Bundle index files must be an object")
+        for name, entry in self.index.items():
+            if not (isinstance(entry, dict) and isinstance(entry.get("size"), int)
+                    and isinstance(entry.get("md5"), str)):
+                raise ValueError(f"Invalid bundle index entry: {name}")
+
+    def md5sum(self, name: str) -> str | None:
+        return self.index.get(name, {}).get("md5")
+
+    def read(self, name: str) -> bytes | None:
+        if name not in self.index:
+            return None
+        with zipfile.ZipFile(self.path) as archive:
+            data = archive.read(name)
+        if len(data) != self.index[name]["size"] or hashlib.md5(data).hexdigest() != self.index[name]["md5"]:
+            console.log(f"{name} in bundle is corrupted!")
+            return None
+        return data
+
+
+mirror: str | None = None
+bundle: Bundle | None = None
+
+
+def use_mirror(url: str | None) -> None:
+    global mirror
+    mirror = url.rstrip("/") if url else None
+
+
+def use_bundle(path: str | None) -> None:
+    """Raises OSError, zipfile.BadZipFile, KeyError, ValueError on invalid bundle"""
+    global bundle
+    bundle = Bundle(path) if path else None
+
+
+def write_bundle(path: str, artifacts: dict[str, bytes]) -> None:
+    with zipfile.ZipFile(path, "w", compression=zipfile.ZIP_STORED) as archive:
+        for name, data in artifacts.items():
+            archive.writestr(name, data)
+        archive.writestr(BUNDLE_INDEX, json.dumps({
+            "files": {
+                name: {"size": len(data), "md5": hashlib.md5(data).hexdigest()}
+                for name, data in artifacts.items()
+            }
+        }))
 
 
 class File:
     def __init__(self, url: str):
         self.name = url.split("/")[-1]
         self.url = url
+        self.path = urllib.parse.urlparse(url).path
         self.filepath = op.join(pwd(), "files/", self.name)
         if not op.exists(op.join(pwd(), "files/")):
             os.mkdir(op.join(pwd(), "files/"))
@@ -23,14 +83,45 @@ class File:
             os.remove(op.join(pwd(), "files/"))
             os.mkdir(op.join(pwd(), "files/"))
 
-    def md5sum(self) -> str | None:
+    @property
+    def download_url(self) -> str:
+        return f"{mirror}{self.path}" if mirror else self.url
+
+    def _server_md5sum(self, server: str) -> str | None:
         try:
-            return json.loads(requests.get(f"https://timoxa0.su/?info={urllib.parse.urlparse(self.url).path}")
+            return json.loads(requests.get(f"{server}/?info={self.path}", timeout=REQUEST_TIMEOUT)
                               .content.decode())["hashes"]["md5"]
-        except requests.ConnectionError:
-            pass
+        except (requests.RequestException, ValueError, KeyError, TypeError):
+            return None
+
+    def md5sum(self) -> str | None:
+        if bundle is not None and bundle.md5sum(self.name):
+            return bundle.md5sum(self.name)
+        md5sum = self._server_md5sum(SERVER)
+        if md5sum is None and mirror:
+            # Mirror vouches for files it serves. Use only when main server is unreachable
+            md5sum = self._server_md5sum(mirror)
+            if md5sum is not None:
+                console.log(f"Warning: {self.name} checksum provided by mirror only")
+        return md5sum
+
+    def get_path(self) -> str:
+        """Path of verified file on disk, for tools which can not read data from memory"""
+        data = self.get()
+        if op.exists(self.filepath):
+            with open(self.filepath, "rb") as file:
+                if file.read() == data:
+                    return self.filepath
+        with open(self.filepath, "wb") as file:
+            file.write(data)
+        return self.filepath
 
     def get(self):
+        if bundle is not None:
+            data = bundle.read(self.name)
+            if data is not None:
+                return data
+
         while True:
             md5sum = self.md5sum()
             if not md5sum:
@@ -43,16 +134,18 @@ class File:
                         return data
 
             download_image = b""
-            r = requests.get(self.url, stream=True)
-            if r.status_code != 200:
-                console.log(f"{self.name} not found on server. Please contact developer")
-            total_size = int(r.headers.get("content-length", 0))
-            block_size = 204800
-            with get_progress() as pbar:
-                task = pbar.add_task(f"[green]Downloading {self.name}", total=total_size)
-                for data in r.iter_content(block_size):
-                    download_image += data
-                    pbar.update(task, advance=len(data))
+            try:
+                r = requests.get(self.download_url, stream=True, timeout=REQUEST_TIMEOUT)
+                if r.status_code != 200:
+                    raise exceptions.ArtifactError(f"{self.name} not found on server. Please contact developer")
+                total_size = int(r.headers.get("content-length", 0))
+                block_size = 204800
+                with bus.transfer(f"[green]Downloading {self.name}", total_size) as transfer:
+                    for data in r.iter_content(block_size):
+                        download_image += data
+                        transfer.advance(len(data))
+            except requests.RequestException as e:
+                raise exceptions.ArtifactError(f"Unable to download {self.name}: {e}")
             with open(self.filepath, "wb") as file:
                 file.write(download_image)
 
@@ -81,3 +174,17 @@ GPT_Both0 = File(
 UserData_Empty = File(
     url="https://timoxa0.su/share/nabu/deployer/userdata.img"
 )
+
+ARTIFACTS = [OrangeFox, UEFI_Payload, BootShim, GPT_Both0, UserData_Empty]
+
+
+def create_bundle(path: str, artifacts: list[File] = ARTIFACTS) -> None:
+    """Raises ArtifactError if some artifact can not be verified"""
+    contents = {}
+    for file in artifacts:
+        md5sum = file.md5sum()
+        data = file.get()
+        if md5sum is None or hashlib.md5(data).hexdigest() != md5sum:
+            raise exceptions.ArtifactError(f"Unable to verify {file.name} checksum")
+        contents[file.name] = data
+    write_bundle(path, contents)
@@ -1,4 +1,5 @@
 import argparse
+import asyncio
 import atexit
 import logging
 import pathlib
@@ -6,33 +7,44 @@ import platform
 import re
 import signal
 import subprocess
-import threading
-from os import getcwd as pwd, remove
+import zipfile
+from os import environ, getcwd as pwd, remove
 from os import path as op
 from sys import exit
-from time import sleep
 
 import adbutils
 import adbutils.shell
+from rich import get_console
 from rich.prompt import Prompt
 from rich_argparse import RichHelpFormatter
 
+from . import aio
+from . import delta
+from . import events
 from . import exceptions
 from . import fastboot
 from . import files
+from . import scheduler
 from ._version import VERSION
-from .utils import get_port, repartition, get_progress, logger, console, check_rootfs
+from .events import bus
+from .utils import get_port, repartition, logger, console, check_rootfs
 
 exit_counter = 0
 exit_counter_needed = False
 
 adb: adbutils.AdbClient | None = None
+deployment: scheduler.Scheduler | None = None
 
 
 def handle_sigint(*_) -> None:
     global exit_counter, exit_counter_needed
     if exit_counter_needed:
-        if exit_counter == 2:
+        if exit_counter >= 2:
+            if exit_counter == 2 and deployment is not None and deployment.cancel():
+                console.log("CTRL+C pressed 3 times. Cancelling deployment")
+                console.log("Press CTRL+C again to exit immediately")
+                exit_counter += 1
+                return
             console.log("CTRL+C pressed 3 times. Exiting")
             exit(1)
         else:
@@ -46,12 +58,186 @@ def handle_sigint(*_) -> None:
 def exit_handler(*_) -> None:
     global adb
     if adb is not None:
-        with console.status("[cyan]Stopping adb server", spinner="line", spinner_style="white"):
-            adb.server_kill()
+        # Host steps may still draw progress bars when exiting on CTRL+C
+        console.log("Stopping adb server")
+        adb.server_kill()
+
+
+async def flash_rootfs(adbd: aio.AsyncDevice, rootfs: pathlib.Path) -> None:
+    server_port = get_port()
+    nc_task = asyncio.create_task(
+        adbd.shell(f"busybox nc -l 127.0.0.1:{server_port} > {delta.LINUX_PART}")
+    )
+    try:
+        await asyncio.sleep(3)
+
+        console.log("Flashing RootFS")
+        async with adbd.create_connection(server_port) as conn:
+            with bus.transfer("[cyan]Uploading RootFS", op.getsize(rootfs), adbd.serial) as transfer:
+                with open(rootfs, "rb") as file:
+                    while data := file.read(1048576):
+                        await conn.write(data, timeout=aio.WRITE_TIMEOUT)
+                        transfer.advance(len(data))
+        await nc_task
+    finally:
+        nc_task.cancel()
+
+
+async def save_file(adbd: aio.AsyncDevice, src: str, dst: str, description: str) -> None:
+    size = int(await adbd.shell(f"stat -c%s {src}"))
+    with bus.transfer(f"[cyan]{description}", size, adbd.serial) as transfer:
+        if op.exists(dst):
+            remove(dst)
+        with open(dst, "ab") as file:
+            async for chunk in adbd.iter_content(src, timeout=60):
+                file.write(chunk)
+                transfer.advance(len(chunk))
+
+
+def deploy_steps(serial: str, rootfs: pathlib.Path, username: str, password: str,
+                 use_delta: bool) -> list[scheduler.Step]:
+    adbd = aio.AsyncDevice(serial)
+    artifacts = {}
+
+    def index_rootfs() -> None:
+        artifacts["index"] = delta.build_index(rootfs)
+
+    def verify_uefi() -> None:
+        artifacts[files.BootShim.name] = files.BootShim.get()
+        artifacts[files.UEFI_Payload.name] = files.UEFI_Payload.get()
+
+    def fetch_ofox() -> None:
+        files.OrangeFox.get_path()
+
+    async def clean() -> None:
+        if use_delta:
+            console.log("Cleaning esp")
+        else:
+            console.log("Cleaning linux and esp")
+            await aio.fastboot(["erase", "linux"], serial)
+        await aio.fastboot(["erase", "esp"], serial)
+
+    async def boot_recovery() -> int:
+        console.log("Booting OrangeFox recovery")
+        try:
+            await aio.fastboot_boot(serial, files.OrangeFox.filepath)
+        except exceptions.UnauthorizedBootImage:
+            console.log("Unable to start orangefox recovery")
+            console.log("Reflash your rom and try again")
+            await aio.fastboot(["reboot"], serial)
+            return 177
+        except exceptions.DeviceNotFound:
+            console.log("Device timed out! Exiting")
+            return 172
+        except subprocess.CalledProcessError as e:
+            console.log("Fastboot error. Please contact developer")
+            console.log("Executed command", e.cmd)
+            return 179
+
+        console.log("Waiting for device")
+        try:
+            await aio.wait_for(serial, state="recovery")
+        except adbutils.errors.AdbTimeout:
+            console.log("Device timed out! Exiting")
+            return 173
+        return 0
+
+    async def format_esp() -> None:
+        console.log("Formating EFI partition")
+        await adbd.shell("mkfs.fat -F32 -s1 /dev/block/platform/soc/1d84000.ufshc/by-name/esp -n ESPNABU")
+        console.log("EFI partition formated")
+
+    async def flash() -> int:
+        try:
+            if use_delta:
+                console.log("Flashing RootFS delta")
+                try:
+                    await delta.flash(adbd, rootfs, artifacts["index"])
+                    return 0
+                except exceptions.DeltaError as e:
+                    logger.debug(e)
+                    console.log("Delta reflash failed. Flashing full RootFS")
+            await flash_rootfs(adbd, rootfs)
+        except adbutils.errors.AdbTimeout:
+            console.log("Device timed out! Exiting")
+            return 173
+        return 0
+
+    async def push_uefi() -> None:
+        bootshim = artifacts[files.BootShim.name]
+        payload = artifacts[files.UEFI_Payload.name]
+        await adbd.shell("mkdir -p /tmp/uefi-install")
+        with bus.transfer("[cyan]Pushing uefi files", len(bootshim) + len(payload), serial) as transfer:
+            await adbd.push(bootshim, f"/tmp/uefi-install/{files.BootShim.name}", timeout=60)
+            transfer.advance(len(bootshim))
+            await adbd.push(payload, f"/tmp/uefi-install/{files.UEFI_Payload.name}", timeout=60)
+            transfer.advance(len(payload))
+
+    async def postinstall() -> int:
+        console.log("Setting up user and creating boot files")
+        if (await adbd.shell2(f"postinstall {username} {password}")).returncode == 0:
+            console.log("User created")
+            console.log("Boot files created")
+        else:
+            console.log("Postinstall failed. Rebooting to system")
+            await adbd.reboot()
+            return 174
+        return 0
+
+    async def install_uefi() -> int:
+        console.log("Installing UEFI")
+        console.log("Patching boot image")
+        match (await adbd.shell2("uefi-patch")).returncode:
+            case 1:
+                console.log("Failed to patch boot. Rebooting")
+                await adbd.reboot()
+                return 176
+            case 2:
+                console.log("Boot image already patched. Skipping")
+                await adbd.reboot()
+            case 0:
+                boot_uefi_path = op.join(pwd(), "new_boot.img")
+                await save_file(adbd, "/tmp/uefi-install/new-boot.img", boot_uefi_path,
+                                "Saving patched boot to disk")
+                console.log(f"Pathed boot saved to {boot_uefi_path}")
+
+                boot_backup_path = op.join(pwd(), "boot_backup.img")
+                await save_file(adbd, "/tmp/uefi-install/boot.img", boot_backup_path,
+                                "Saving boot backup to disk")
+                console.log(f"Boot backup saved to {boot_backup_path}")
+
+                console.log("Rebooting to bootloader")
+                await adbd.reboot("bootloader")
+                try:
+                    await aio.wait_for_bootloader(serial)
+                except exceptions.DeviceNotFound:
+                    console.log("Device timed out! Exiting")
+                    return 172
+                console.log("Flashing patched boot")
+                await aio.fastboot(["flash", "boot", boot_uefi_path], serial)
+                await aio.fastboot(["reboot"], serial)
+        return 0
+
+    return [
+        # Host steps keep results in memory, so they run again on resume
+        *([scheduler.Step("index_rootfs", index_rootfs, persist=False)] if use_delta else []),
+        scheduler.Step("verify_uefi", verify_uefi, persist=False),
+        scheduler.Step("fetch_ofox", fetch_ofox, persist=False),
+        scheduler.Step("clean", clean, mode="fastboot"),
+        scheduler.Step("boot_recovery", boot_recovery, requires=("clean", "fetch_ofox"),
+                       mode="fastboot", enters="recovery"),
+        scheduler.Step("format_esp", format_esp, requires=("boot_recovery",), mode="recovery"),
+        scheduler.Step("flash_rootfs", flash, requires=("boot_recovery",) + (("index_rootfs",) if use_delta else ()),
+                       mode="recovery"),
+        scheduler.Step("push_uefi", push_uefi, requires=("boot_recovery", "verify_uefi"),
+                       mode="recovery", persist=False),
+        scheduler.Step("postinstall", postinstall, requires=("format_esp", "flash_rootfs"), mode="recovery"),
+        scheduler.Step("install_uefi", install_uefi, requires=("postinstall", "push_uefi"), mode="recovery"),
+    ]
 
 
 def main() -> int:
-    global adb, exit_counter_needed
+    global adb, deployment, exit_counter_needed
 
     signal.signal(signal.SIGINT, handle_sigint)
     atexit.register(exit_handler)
@@ -97,6 +283,37 @@ def main() -> int:
         "-S", "--part-size",
         help="linux partition size in percents"
     )
+    parser.add_argument(
+        "--delta",
+        help="write only blocks that differ from installed RootFS",
+        action="store_true"
+    )
+    parser.add_argument(
+        "--resume",
+        help="resume failed deployment from last completed step",
+        action="store_true"
+    )
+    parser.add_argument(
+        "--mirror",
+        help="artifacts mirror base url (env LND_MIRROR)",
+        default=environ.get("LND_MIRROR")
+    )
+    parser.add_argument(
+        "--bundle",
+        help="offline artifacts bundle (env LND_BUNDLE)",
+        default=environ.get("LND_BUNDLE")
+    )
+    parser.add_argument(
+        "--create-bundle",
+        help="download artifacts to bundle and exit",
+        metavar="BUNDLE"
+    )
+    parser.add_argument(
+        "--progress",
+        help="progress output: rich bars, json lines on stdout or none",
+        choices=["rich", "json", "none"],
+        default="rich"
+    )
     parser.add_argument(
         "--debug",
         help="enable debug output",
@@ -114,6 +331,32 @@ def main() -> int:
     else:
         logger.setLevel(logging.INFO)
 
+    match args.progress:
+        case "json":
+            # Keep stdout for json lines only
+            for output in (console, get_console()):
+                output.stderr = True
+            bus.sink = events.JsonSink()
+        case "none":
+            bus.sink = events.NullSink()
+
+    files.use_mirror(args.mirror)
+    try:
+        files.use_bundle(args.bundle)
+    except (OSError, zipfile.BadZipFile, KeyError, ValueError):
+        console.log("Invalid artifacts bundle")
+        return 180
+
+    if args.create_bundle:
+        try:
+            files.create_bundle(args.create_bundle)
+        except exceptions.ArtifactError as e:
+            console.log(str(e))
+            console.log("Bundle not created")
+            return 181
+        console.log(f"Bundle saved to {args.create_bundle}")
+        return 0
+
     if args.RootFS:
         rootfs = pathlib.Path(args.RootFS)
         try:
@@ -247,10 +490,17 @@ def main() -> int:
                 default="n", choices=["y", "n"]) == "y":
             exit_counter_needed = True
             console.log("Restoring stock partition table")
-            fastboot.restore_parts(serial)
+            try:
+                fastboot.restore_parts(serial)
+            except exceptions.ArtifactError as e:
+                console.log(str(e))
+                return 181
             console.log("Booting OrangeFox recovery")
             try:
                 fastboot.boot_ofox(serial)
+            except exceptions.ArtifactError as e:
+                console.log(str(e))
+                return 181
             except exceptions.UnauthorizedBootImage:
                 console.log("Unable to start orangefox recovery")
                 console.log("Reflash your rom and try again")
@@ -263,7 +513,7 @@ def main() -> int:
             with console.status("[cyan]Waiting for device", spinner="line", spinner_style="white"):
                 try:
                     adb.wait_for(serial, state="recovery")
-                except adbutils.errors.AdbTimeout():
+                except adbutils.errors.AdbTimeout:
                     console.log("Device timed out! Exiting")
                     return 173
             repartition(serial, int(linux_part_size.replace("%", "")), percents=True)
@@ -288,120 +538,51 @@ def main() -> int:
         console.log("Incompatible partition table detected. Repartition needed. Exiting")
         return 174
 
-    console.log("Cleaning linux and esp")
-    fastboot.clean_device(serial)
-
-    console.log("Booting OrangeFox recovery")
-
+    use_delta = args.delta
+    resume = args.resume
+    if linux_part_size:
+        if use_delta:
+            console.log("Linux partition recreated. Delta reflash disabled")
+            use_delta = False
+        resume = False
+
+    # Replaced image invalidates saved state, same check as block index cache
+    rootfs_stat = rootfs.stat()
+    deployment = scheduler.Scheduler(
+        deploy_steps(serial, rootfs, username, password, use_delta),
+        mode="fastboot",
+        state_file=op.join(pwd(), f"deploy_state_{serial}.json"),
+        key=f"{rootfs.absolute()}:{rootfs_stat.st_size}:{rootfs_stat.st_mtime_ns}:{use_delta}",
+        resume=resume,
+        device=serial
+    )
     try:
-        fastboot.boot_ofox(serial)
-    except exceptions.UnauthorizedBootImage:
-        console.log("Unable to start orangefox recovery")
-        console.log("Reflash your rom and try again")
-        fastboot.reboot(serial)
-        return 177
+        code = asyncio.run(deployment.run())
+    except asyncio.CancelledError:
+        console.log("Deployment cancelled. Use --resume to continue from last completed step")
+        bus.event("result", device=serial, code=1)
+        return 1
+    except exceptions.ArtifactError as e:
+        console.log(str(e))
+        code = 181
+    except exceptions.DeviceNotFound:
+        console.log("Device timed out! Exiting")
+        code = 172
+    except adbutils.errors.AdbTimeout:
+        console.log("Device timed out! Exiting")
+        code = 173
     except subprocess.CalledProcessError as e:
         console.log("Fastboot error. Please contact developer")
         console.log("Executed command", e.cmd)
-        return 179 
-
-    with console.status("[cyan]Waiting for device", spinner="line", spinner_style="white"):
-        try:
-            adb.wait_for(serial, state="recovery")
-        except adbutils.errors.AdbTimeout():
-            console.log("Device timed out! Exiting")
-            return 173
-
-    adbd = adb.device(serial)
-
-    with console.status("[cyan]Formating EFI partition", spinner="line", spinner_style="white"):
-        adbd.shell("mkfs.fat -F32 -s1 /dev/block/platform/soc/1d84000.ufshc/by-name/esp -n ESPNABU")
-    console.log("EFI partition formated")
-    server_port = get_port()
-    nc_thread = threading.Thread(
-        target=adbd.shell,
-        args=(f"busybox nc -l 127.0.0.1:{server_port} > /dev/block/platform/soc/1d84000.ufshc/by-name/linux",),
-        daemon=True
-    )
-    nc_thread.start()
-    sleep(3)
-
-    console.log("Flashing RootFS")
-    with adbd.create_connection(adbutils.Network.TCP, server_port) as conn:
-        with get_progress() as pbar:
-            task = pbar.add_task("[cyan]Uploading RootFS", total=op.getsize(rootfs))
-            with open(rootfs, "rb") as rootfs:
-                while True:
-                    data = rootfs.read(10240)
-                    conn.send(data)
-                    pbar.update(task, advance=len(data))
-                    if len(data) < 10240:
-                        break
-        conn.close()
-
-    nc_thread.join()
-
-    with console.status("[cyan]Setting up user and creating boot files", spinner="line", spinner_style="white"):
-        if adbd.shell2(f"postinstall {username} {password}").returncode == 0:
-            console.log("User created")
-            console.log("Boot files created")
-        else:
-            console.log("Postinstall failed. Rebooting to system")
-            adbd.reboot()
-            return 174
-
-    console.log("Installing UEFI")
-    bootshim = files.BootShim.get()
-    payload = files.UEFI_Payload.get()
-    adbd.shell("mkdir /tmp/uefi-install")
-    with get_progress() as pbar:
-        task = pbar.add_task("[cyan]Pushing uefi files", total=2)
-        adbd.sync.push(bootshim, f"/tmp/uefi-install/{files.BootShim.name}")
-        pbar.update(task, advance=1)
-        adbd.sync.push(payload, f"/tmp/uefi-install/{files.UEFI_Payload.name}")
-        pbar.update(task, advance=1)
-
-    console.log("Patching boot image")
-    match adbd.shell2("uefi-patch").returncode:
-        case 1:
-            console.log("Failed to patch boot. Rebooting")
-            adbd.reboot()
-            return 176
-        case 2:
-            console.log("Boot image already patched. Skipping")
-            adbd.reboot()
-        case 0:
-            patched_size = int(adbd.shell("stat -c%s /tmp/uefi-install/new-boot.img"))
-            with get_progress() as pbar:
-                task = pbar.add_task("[cyan]Saving patched boot to disk", total=patched_size)
-                boot_uefi_path = op.join(pwd(), "new_boot.img")
-                if op.exists(boot_uefi_path):
-                    remove(boot_uefi_path)
-                with open(boot_uefi_path, "ab") as file:
-                    for chunk in adbd.sync.iter_content("/tmp/uefi-install/new-boot.img"):
-                        file.write(chunk)
-                        pbar.update(task, advance=len(chunk))
-            console.log(f"Pathed boot saved to {boot_uefi_path}")
-
-            backup_size = int(adbd.shell("stat -c%s /tmp/uefi-install/boot.img"))
-            with get_progress() as pbar:
-                task = pbar.add_task("[cyan]Saving boot backup to disk", total=backup_size)
-                boot_backup_path = op.join(pwd(), "boot_backup.img")
-                if op.exists(boot_backup_path):
-                    remove(boot_backup_path)
-                with open(boot_backup_path, "ab") as file:
-                    for chunk in adbd.sync.iter_content("/tmp/uefi-install/new-boot.img"):
-                        file.write(chunk)
-                        pbar.update(task, advance=len(chunk))
-            console.log(f"Boot backup saved to {boot_backup_path}")
-
-            console.log("Rebooting to bootloader")
-            adbd.shell("reboot bootloader")
-            fastboot.wait_for_bootloader(serial)
-            console.log("Flashing patched boot")
-            with open(boot_uefi_path, "rb") as file:
-                fastboot.flash(serial, "boot", file.read())
-            fastboot.reboot(serial)
+        code = 179
+    except (adbutils.errors.AdbError, ConnectionError) as e:
+        console.log(f"Device connection error: {e}")
+        code = 179
+    bus.event("result", device=serial, code=code)
+    if code:
+        console.log("Deployment failed. Use --resume to continue from last completed step")
+        return code
+    deployment.clear()
 
     console.log("Done!")
     return 0
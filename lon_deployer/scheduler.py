@@ -0,0 +1,192 @@
+import asyncio
+import inspect
+import json
+import os
+import threading
+from dataclasses import dataclass
+from typing import Awaitable, Callable
+
+from . import exceptions
+from .events import bus
+from .utils import logger
+
+
+@dataclass
+class Step:
+    name: str
+    # Coroutine functions run in event loop, plain functions in a daemon thread
+    run: Callable[[], int | None] | Callable[[], Awaitable[int | None]]
+    requires: tuple[str, ...] = ()
+    # Device mode the step runs in. None for host-only steps
+    mode: str | None = None
+    # Device mode after the step. Mode switching steps are never saved as completed
+    enters: str | None = None
+    # Whether the step result survives a reboot of the device
+    persist: bool = True
+
+
+class Scheduler:
+    """Runs steps as soon as their requirements are met, independent steps run concurrently.
+
+    A step returning a non-zero code stops scheduling of new steps. Completed steps are saved
+    to state_file, so a failed or cancelled deployment can be resumed.
+    """
+
+    def __init__(self, steps: list[Step], mode: str, state_file: str | None = None,
+                 key: str | None = None, resume: bool = False, device: str | None = None):
+        self.device = device
+        self.steps = {step.name: step for step in steps}
+        self.mode = mode
+        self.state_file = state_file
+        self.key = key
+        self.completed: set[str] = self._load() if resume else set()
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._running: dict[asyncio.Task, Step] = {}
+        self._cancelled = False
+        for step in steps:
+            for name in step.requires:
+                if name not in self.steps:
+                    raise exceptions.SchedulerError(f"{step.name} requires unknown step {name}")
+
+    def _load(self) -> set[str]:
+        try:
+            with open(self.state_file, "r") as file:
+                state = json.load(file)
+            if state["key"] != self.key:
+                logger.debug("Saved deployment state does not match. Ignoring it")
+                return set()
+            return set(state["completed"]) & set(self.steps)
+        except (TypeError, FileNotFoundError, ValueError, KeyError):
+            return set()
+
+    def _save(self) -> None:
+        if self.state_file is None:
+            return
+        with open(self.state_file, "w") as file:
+            json.dump({
+                "key": self.key,
+                "completed": sorted(
+                    name for name in self.completed
+                    if self.steps[name].persist and self.steps[name].enters is None
+                )
+            }, file)
+
+    def clear(self) -> None:
+        if self.state_file is not None and os.path.exists(self.state_file):
+            os.remove(self.state_file)
+
+    def _pending(self) -> dict[str, Step]:
+        pending = {name: step for name, step in self.steps.items() if name not in self.completed}
+        # Mode switch is only needed if some remaining step runs in that mode
+        modes = {step.mode for step in pending.values() if step.enters is None}
+        return {name: step for name, step in pending.items() if step.enters is None or step.enters in modes}
+
+    def _ready(self, pending: dict[str, Step], done: set[str], running: list[Step]) -> list[Step]:
+        ready = []
+        busy = [step for step in running if step.mode is not None]
+        for step in pending.values():
+            if not set(step.requires) <= done:
+                continue
+            if step.mode is not None:
+                if step.mode != self.mode or any(x.enters for x in busy) or (step.enters and busy):
+                    continue
+                busy.append(step)
+            ready.append(step)
+        return ready
+
+    def cancel(self) -> bool:
+        """Cancel running steps. Safe to call from signal handler.
+
+        Returns False if scheduler is not running or cancel was already requested.
+        """
+        if self._loop is None or self._cancelled:
+            return False
+        self._cancelled = True
+        self._loop.call_soon_threadsafe(self._cancel)
+        return True
+
+    def _cancel(self) -> None:
+        for task in self._running:
+            task.cancel()
+
+    @staticmethod
+    async def _start(step: Step) -> int | None:
+        if inspect.iscoroutinefunction(step.run):
+            return await step.run()
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def resolve(result: int | None, error: BaseException | None) -> None:
+            if future.done():
+                return
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+        def worker() -> None:
+            try:
+                result = step.run()
+            except BaseException as e:
+                loop.call_soon_threadsafe(resolve, None, e)
+            else:
+                loop.call_soon_threadsafe(resolve, result, None)
+
+        # Daemon thread does not block exit if the step is cancelled
+        threading.Thread(target=worker, daemon=True).start()
+        return await future
+
+    async def run(self) -> int:
+        self._loop = asyncio.get_running_loop()
+        self._cancelled = False
+        pending = self._pending()
+        done = set(self.steps) - set(pending)
+        running = self._running
+        code = 0
+        error = None
+
+        for name in sorted(done):
+            logger.debug(f"Skipping step {name}")
+
+        while pending or running:
+            if not code and error is None and not self._cancelled:
+                for step in self._ready(pending, done, list(running.values())):
+                    logger.debug(f"Starting step {step.name}")
+                    bus.event("step", device=self.device, step=step.name, status="started")
+                    del pending[step.name]
+                    running[asyncio.create_task(self._start(step))] = step
+            if not running:
+                if code or error is not None or self._cancelled:
+                    break
+                raise exceptions.SchedulerError(f"Unable to run steps: {', '.join(pending)}")
+
+            finished, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+            for task in finished:
+                step = running.pop(task)
+                if task.cancelled():
+                    logger.debug(f"Step {step.name} cancelled")
+                    bus.event("step", device=self.device, step=step.name, status="cancelled")
+                elif task.exception() is not None:
+                    logger.debug(f"Step {step.name} raised {task.exception()!r}")
+                    error = error or task.exception()
+                    bus.event("step", device=self.device, step=step.name, status="error")
+                elif task.result():
+                    logger.debug(f"Step {step.name} failed with code {task.result()}")
+                    code = code or task.result()
+                    bus.event("step", device=self.device, step=step.name, status="failed", code=task.result())
+                else:
+                    logger.debug(f"Step {step.name} completed")
+                    bus.event("step", device=self.device, step=step.name, status="completed")
+                    done.add(step.name)
+                    self.completed.add(step.name)
+                    if step.enters is not None:
+                        self.mode = step.enters
+                    self._save()
+
+        self._loop = None
+        if error is not None:
+            raise error
+        if self._cancelled:
+            raise asyncio.CancelledError()
+        return code
@@ -48,6 +48,7 @@ def get_progress() -> Progress:
         TransferSpeedColumn(),
         "•",
         TimeRemainingColumnCustom(),
+        console=console,
     )
 
 
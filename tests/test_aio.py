@@ -0,0 +1,52 @@
+import asyncio
+import struct
+
+from lon_deployer import aio
+
+
+async def fake_adb(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+    files = {}
+    while True:
+        size = await reader.read(4)
+        if not size:
+            break
+        cmd = (await reader.readexactly(int(size, 16))).decode()
+        writer.write(b"OKAY")
+        if cmd.startswith("shell:"):
+            writer.write(b"hello\nX4EXIT:3\n" if "X4EXIT" in cmd else b"hello\n")
+            break
+        elif cmd == "sync:":
+            request, length = struct.unpack("<4sI", await reader.readexactly(8))
+            path = (await reader.readexactly(length)).decode()
+            if request == b"SEND":
+                data = b""
+                while True:
+                    chunk_cmd, chunk_size = struct.unpack("<4sI", await reader.readexactly(8))
+                    if chunk_cmd == b"DONE":
+                        break
+                    data += await reader.readexactly(chunk_size)
+                files[path.split(",")[0]] = data
+                writer.write(b"OKAY\0\0\0\0")
+            elif request == b"RECV":
+                data = b"content"
+                writer.write(b"DATA" + struct.pack("<I", len(data)) + data + b"DONE\0\0\0\0")
+            break
+    await writer.drain()
+    writer.close()
+
+
+async def run_device() -> None:
+    server = await asyncio.start_server(fake_adb, "127.0.0.1", 0)
+    port = server.sockets[0].getsockname()[1]
+    device = aio.AsyncDevice("serial", port=port)
+    async with server:
+        assert await device.shell("echo hello", timeout=5) == "hello"
+        result = await device.shell2("false", timeout=5)
+        assert result.returncode == 3
+        assert result.output == "hello\n"
+        await device.push(b"x" * 100000, "/tmp/file", timeout=5)
+        assert [chunk async for chunk in device.iter_content("/tmp/file", timeout=5)] == [b"content"]
+
+
+def test_device() -> None:
+    asyncio.run(run_device())
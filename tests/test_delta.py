@@ -0,0 +1,25 @@
+from lon_deployer import delta
+
+
+def test_changed_runs() -> None:
+    local = ["a", "b", "c", "d", "e"]
+    remote = ["a", "x", "x", "d", "x"]
+    assert delta.changed_runs(local, remote) == [(1, 2), (4, 1)]
+    assert delta.changed_runs(local, local) == []
+    assert delta.changed_runs(local, []) == [(0, 5)]
+
+
+def test_build_index(tmp_path) -> None:
+    image = tmp_path / "rootfs.img"
+    image.write_bytes(b"\0" * 10 + b"\1" * 6)
+    hashes = delta.build_index(image, block_size=8)
+    assert len(hashes) == 2
+    assert delta.index_path(image).exists()
+    assert delta.build_index(image, block_size=8) == hashes
+
+
+def test_write_script() -> None:
+    script = delta._write_script(1234, [(1, 2), (5, 1)], 8)
+    assert script.count("busybox dd") == 2
+    assert " &&\n" in script
+    assert script.rstrip().endswith("exit $status")
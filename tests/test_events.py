@@ -0,0 +1,28 @@
+import io
+import json
+
+from lon_deployer import events
+
+
+def test_json_sink() -> None:
+    stream = io.StringIO()
+    bus = events.EventBus(events.JsonSink(stream, interval=60))
+    with bus.transfer("[cyan]Uploading RootFS", 100, device="serial") as transfer:
+        transfer.advance(40)
+        transfer.advance(60)
+    bus.event("step", device="serial", step="flash_rootfs", status="completed")
+
+    records = [json.loads(line) for line in stream.getvalue().splitlines()]
+    assert records[0]["type"] == "progress"
+    assert records[0]["task"] == "Uploading RootFS"
+    assert records[0]["completed"] == 100
+    assert records[0]["done"]
+    assert records[-1]["event"] == "step"
+    assert records[-1]["status"] == "completed"
+
+
+def test_null_sink() -> None:
+    bus = events.EventBus(events.NullSink())
+    with bus.transfer("Downloading", 10) as transfer:
+        transfer.advance(10)
+    assert transfer.finished
@@ -1,4 +1,9 @@
-from lon_deployer import files
+import json
+import zipfile
+
+import pytest
+
+from lon_deployer import exceptions, files
 
 
 def test_ofox() -> None:
@@ -6,3 +11,42 @@ def test_ofox() -> None:
     assert file.name == "orangefox.img"
     assert file.md5sum() == "3edc8c32db0384006caf8cf066257811"
 
+
+def test_bundle(tmp_path) -> None:
+    bundle = str(tmp_path / "bundle.zip")
+    files.write_bundle(bundle, {"orangefox.img": b"ofox"})
+    files.use_bundle(bundle)
+    try:
+        assert files.OrangeFox.md5sum() == "f5563e77181710ade75438854bc59615"
+        assert files.OrangeFox.get() == b"ofox"
+    finally:
+        files.use_bundle(None)
+
+
+def test_mirror() -> None:
+    files.use_mirror("http://192.168.1.2:8080/")
+    try:
+        assert files.OrangeFox.download_url == "http://192.168.1.2:8080/share/nabu/deployer/orangefox.img"
+    finally:
+        files.use_mirror(None)
+    assert files.OrangeFox.download_url == files.OrangeFox.url
+
+
+def test_bundle_unverified(tmp_path, monkeypatch) -> None:
+    monkeypatch.chdir(tmp_path)
+    file = files.File("https://example.com/share/unverified.bin")
+    with open(file.filepath, "wb") as f:
+        f.write(b"data")
+    monkeypatch.setattr(file, "md5sum", lambda: None)
+    with pytest.raises(exceptions.ArtifactError):
+        files.create_bundle(str(tmp_path / "bundle.zip"), [file])
+
+
+def test_bundle_invalid_index(tmp_path) -> None:
+    bundle = tmp_path / "bundle.zip"
+    with zipfile.ZipFile(bundle, "w") as archive:
+        archive.writestr(files.BUNDLE_INDEX, json.dumps({"files": {"orangefox.img": {"size": 4}}}))
+    with pytest.raises(ValueError):
+        files.use_bundle(str(bundle))
+    with pytest.raises(OSError):
+        files.use_bundle(str(tmp_path))
@@ -0,0 +1,78 @@
+import asyncio
+
+from lon_deployer import scheduler
+
+
+def make_steps(log: list[str], fail: str | None = None) -> list[scheduler.Step]:
+    def step(name: str):
+        def run() -> int:
+            log.append(name)
+            return 1 if name == fail else 0
+        return run
+
+    return [
+        scheduler.Step("verify", step("verify")),
+        scheduler.Step("clean", step("clean"), mode="fastboot"),
+        scheduler.Step("boot", step("boot"), requires=("clean",), mode="fastboot", enters="recovery"),
+        scheduler.Step("flash", step("flash"), requires=("boot",), mode="recovery"),
+        scheduler.Step("push", step("push"), requires=("boot", "verify"), mode="recovery", persist=False),
+        scheduler.Step("install", step("install"), requires=("flash", "push"), mode="recovery"),
+    ]
+
+
+def test_order() -> None:
+    log = []
+    assert asyncio.run(scheduler.Scheduler(make_steps(log), mode="fastboot").run()) == 0
+    assert sorted(log) == sorted(["verify", "clean", "boot", "flash", "push", "install"])
+    assert log.index("boot") > log.index("clean")
+    assert log[-1] == "install"
+
+
+def test_resume(tmp_path) -> None:
+    state = str(tmp_path / "state.json")
+    log = []
+    deployment = scheduler.Scheduler(make_steps(log, fail="install"), mode="fastboot", state_file=state, key="a")
+    assert asyncio.run(deployment.run()) == 1
+
+    log = []
+    deployment = scheduler.Scheduler(make_steps(log), mode="fastboot", state_file=state, key="a", resume=True)
+    assert asyncio.run(deployment.run()) == 0
+    assert sorted(log) == ["boot", "install", "push"]
+
+    log = []
+    deployment = scheduler.Scheduler(make_steps(log), mode="fastboot", state_file=state, key="b", resume=True)
+    assert asyncio.run(deployment.run()) == 0
+    assert len(log) == 6
+
+
+def test_async_step() -> None:
+    log = []
+
+    async def boot() -> None:
+        await asyncio.sleep(0)
+        log.append("boot")
+
+    steps = make_steps(log)
+    steps[2] = scheduler.Step("boot", boot, requires=("clean",), mode="fastboot", enters="recovery")
+    assert asyncio.run(scheduler.Scheduler(steps, mode="fastboot").run()) == 0
+    assert log[-1] == "install" and "boot" in log
+
+
+def test_cancel() -> None:
+    async def hang() -> None:
+        await asyncio.Event().wait()
+
+    async def run() -> None:
+        deployment = scheduler.Scheduler([scheduler.Step("hang", hang)], mode="fastboot")
+        task = asyncio.create_task(deployment.run())
+        await asyncio.sleep(0.01)
+        assert deployment.cancel()
+        assert not deployment.cancel()
+        await task
+
+    try:
+        asyncio.run(run())
+    except asyncio.CancelledError:
+        pass
+    else:
+        assert False, "deployment was not cancelled"